@@ -0,0 +1,247 @@
+"""
+Generate the keyboard layout tables under `src/layouts`.
+
+Each layout maps Unicode KeyIDs to the HID keycode and modifiers that produce the
+character on a host configured with that layout. Characters without a key of their
+own are composed with a dead key followed by the base character.
+
+The tables are packed bytes so they stay small in RAM and lookups are O(1):
+    pages   256 bytes, page number for every high byte of the KeyID, 0 if no character on that page
+    data    2 bytes per KeyID for every page: keycode, flags
+    dead    4 bytes per composed character: dead keycode, dead flags, base keycode, base flags
+If the DEAD flag is set, the keycode in `data` is the index into `dead`.
+If the ANY_SHIFT flag is set, shift doesn't change the character, e.g. space, so a held shift is kept.
+
+Usage:
+    python genlayout.py
+"""
+
+import os
+import unicodedata
+
+# Flags, must match `src/key_codes.py`
+SHIFT = 0x01
+ALTGR = 0x02
+ANY_SHIFT = 0x04
+DEAD = 0x80
+
+LEVELS = [0, SHIFT, ALTGR, SHIFT | ALTGR]
+
+# KeyIDs in this range are control keys, see `gentable.c`
+CONTROL_KEYS = range(0xE000, 0xF100)
+
+# Spacing forms produced by pressing a dead key followed by space
+SPACING = {
+    "\u0300": "`",
+    "\u0301": "´",
+    "\u0302": "^",
+    "\u0303": "~",
+    "\u0308": "¨",
+    "\u030a": "°",
+    "\u0327": "¸",
+}
+
+HID_SPACE = 0x2C
+
+# HID keycodes of the letter keys on a US keyboard
+LETTERS = {
+    "a": 0x04, "b": 0x05, "c": 0x06, "d": 0x07, "e": 0x08, "f": 0x09, "g": 0x0A,
+    "h": 0x0B, "i": 0x0C, "j": 0x0D, "k": 0x0E, "l": 0x0F, "m": 0x10, "n": 0x11,
+    "o": 0x12, "p": 0x13, "q": 0x14, "r": 0x15, "s": 0x16, "t": 0x17, "u": 0x18,
+    "v": 0x19, "w": 0x1A, "x": 0x1B, "y": 0x1C, "z": 0x1D,
+}
+
+def letters(*skip):
+    """
+    Letter keys at their US position, lower case and upper case with shift.
+    """
+    return [(k, c, c.upper()) for (c, k) in LETTERS.items() if c not in skip]
+
+# Key definitions: (keycode, normal, shift, altgr, shift+altgr), dead keys are combining characters
+LAYOUTS = {
+    "us": letters() + [
+        (0x2C, " ", " "),
+        (0x35, "`", "~"),
+        (0x1E, "1", "!"),
+        (0x1F, "2", "@"),
+        (0x20, "3", "#"),
+        (0x21, "4", "$"),
+        (0x22, "5", "%"),
+        (0x23, "6", "^"),
+        (0x24, "7", "&"),
+        (0x25, "8", "*"),
+        (0x26, "9", "("),
+        (0x27, "0", ")"),
+        (0x2D, "-", "_"),
+        (0x2E, "=", "+"),
+        (0x2F, "[", "{"),
+        (0x30, "]", "}"),
+        (0x31, "\\", "|"),
+        (0x33, ";", ":"),
+        (0x34, "'", "\""),
+        (0x36, ",", "<"),
+        (0x37, ".", ">"),
+        (0x38, "/", "?"),
+    ],
+    "gb": letters() + [
+        (0x2C, " ", " "),
+        (0x35, "`", "¬", "¦"),
+        (0x1E, "1", "!"),
+        (0x1F, "2", "\""),
+        (0x20, "3", "£"),
+        (0x21, "4", "$", "€"),
+        (0x22, "5", "%"),
+        (0x23, "6", "^"),
+        (0x24, "7", "&"),
+        (0x25, "8", "*"),
+        (0x26, "9", "("),
+        (0x27, "0", ")"),
+        (0x2D, "-", "_"),
+        (0x2E, "=", "+"),
+        (0x2F, "[", "{"),
+        (0x30, "]", "}"),
+        (0x32, "#", "~"),
+        (0x33, ";", ":"),
+        (0x34, "'", "@"),
+        (0x64, "\\", "|"),
+        (0x36, ",", "<"),
+        (0x37, ".", ">"),
+        (0x38, "/", "?"),
+    ],
+    "de": letters("y", "z") + [
+        (0x1C, "z", "Z"),
+        (0x1D, "y", "Y"),
+        (0x14, "q", "Q", "@"),
+        (0x08, "e", "E", "€"),
+        (0x10, "m", "M", "µ"),
+        (0x2C, " ", " "),
+        (0x35, "\u0302", "°"),
+        (0x1E, "1", "!"),
+        (0x1F, "2", "\"", "²"),
+        (0x20, "3", "§", "³"),
+        (0x21, "4", "$"),
+        (0x22, "5", "%"),
+        (0x23, "6", "&"),
+        (0x24, "7", "/", "{"),
+        (0x25, "8", "(", "["),
+        (0x26, "9", ")", "]"),
+        (0x27, "0", "=", "}"),
+        (0x2D, "ß", "?", "\\"),
+        (0x2E, "\u0301", "\u0300"),
+        (0x2F, "ü", "Ü"),
+        (0x30, "+", "*", "~"),
+        (0x32, "#", "'"),
+        (0x33, "ö", "Ö"),
+        (0x34, "ä", "Ä"),
+        (0x64, "<", ">", "|"),
+        (0x36, ",", ";"),
+        (0x37, ".", ":"),
+        (0x38, "-", "_"),
+    ],
+    "fr": letters("a", "q", "z", "w", "m") + [
+        (0x14, "a", "A"),
+        (0x04, "q", "Q"),
+        (0x1A, "z", "Z"),
+        (0x1D, "w", "W"),
+        (0x33, "m", "M"),
+        (0x08, "e", "E", "€"),
+        (0x2C, " ", " "),
+        (0x35, "²"),
+        (0x1E, "&", "1"),
+        (0x1F, "é", "2", "\u0303"),
+        (0x20, "\"", "3", "#"),
+        (0x21, "'", "4", "{"),
+        (0x22, "(", "5", "["),
+        (0x23, "-", "6", "|"),
+        (0x24, "è", "7", "\u0300"),
+        (0x25, "_", "8", "\\"),
+        (0x26, "ç", "9", "^"),
+        (0x27, "à", "0", "@"),
+        (0x2D, ")", "°", "]"),
+        (0x2E, "=", "+", "}"),
+        (0x2F, "\u0302", "\u0308"),
+        (0x30, "$", "£", "¤"),
+        (0x34, "ù", "%"),
+        (0x32, "*", "µ"),
+        (0x64, "<", ">"),
+        (0x10, ",", "?"),
+        (0x36, ";", "."),
+        (0x37, ":", "/"),
+        (0x38, "!", "§"),
+    ],
+}
+
+def build(keys):
+    """
+    Build the KeyID to (keycode, flags) and KeyID to dead key sequence mappings.
+    """
+    direct = {}
+    # Keep the definition with the fewest modifiers
+    for (n, level) in enumerate(LEVELS):
+        for key in keys:
+            if len(key) > n + 1 and ord(key[n + 1]) not in direct:
+                direct[ord(key[n + 1])] = (key[0], level)
+    # Keys typing the same character with and without shift
+    for key in keys:
+        if len(key) > 2 and key[1] == key[2] and direct[ord(key[1])] == (key[0], 0):
+            direct[ord(key[1])] = (key[0], ANY_SHIFT)
+
+    dead = {}
+    dead_keys = [(id, entry) for (id, entry) in sorted(direct.items()) if unicodedata.combining(chr(id))]
+    for (mark, dead_entry) in dead_keys:
+        for (base, base_entry) in sorted(direct.items()):
+            if unicodedata.combining(chr(base)):
+                continue
+            composed = unicodedata.normalize("NFC", chr(base) + chr(mark))
+            if len(composed) != 1 or ord(composed) in direct or ord(composed) in dead:
+                continue
+            dead[ord(composed)] = dead_entry + base_entry
+        spacing = SPACING.get(chr(mark))
+        if spacing is not None and ord(spacing) not in direct and ord(spacing) not in dead:
+            dead[ord(spacing)] = dead_entry + (HID_SPACE, 0)
+    return direct, dead
+
+def pack(direct, dead):
+    """
+    Pack the mappings into the page, data and dead tables.
+    """
+    entries = dict(direct)
+    dead_table = bytearray()
+    for (n, (id, sequence)) in enumerate(sorted(dead.items())):
+        if n > 0xFF:
+            raise ValueError("Too many composed characters")
+        entries[id] = (n, DEAD)
+        dead_table += bytes(sequence)
+
+    pages = bytearray(256)
+    data = bytearray()
+    for id in sorted(entries):
+        if id > 0xFFFF or id in CONTROL_KEYS:
+            continue
+        page = id >> 8
+        if pages[page] == 0:
+            data += bytes(512)
+            pages[page] = len(data) // 512
+        o = (pages[page] - 1) * 512 + (id & 0xFF) * 2
+        data[o] = entries[id][0]
+        data[o+1] = entries[id][1]
+    return pages, data, dead_table
+
+def literal(data):
+    return "b'" + "".join("\\x%02X" % b for b in data) + "'"
+
+def main():
+    out = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "layouts")
+    for (name, keys) in LAYOUTS.items():
+        direct, dead = build(keys)
+        pages, data, dead_table = pack(direct, dead)
+        with open(os.path.join(out, name + ".py"), "w") as f:
+            f.write("# Generated by genlayout.py, do not edit.\n")
+            f.write("pages = %s\n" % literal(pages))
+            f.write("data = %s\n" % literal(data))
+            f.write("dead = %s\n" % literal(dead_table))
+        print("%s: %d characters, %d composed, %d bytes" % (
+            name, len(direct), len(dead), len(pages) + len(data) + len(dead_table)))
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ Barrier client protocol implementation.
 @see https://qemu.readthedocs.io/en/latest/interop/barrier.html
 """
 
+import event_trace
 import utils
 
 # Field types
@@ -41,28 +42,30 @@ class BarrierMessage:
         return len(self.buffer)
 
     def __getattr__(self, name):
+        # Fields are decoded byte by byte, slicing the buffer would allocate on every access
         for (n, type, offset) in self.FIELD_DEF:
             offset = offset + len(self.CMD)
             if n == name:
+                buffer = self.buffer
                 if type == INT8:
-                    return self.buffer[offset]
+                    return buffer[offset]
                 elif type == INT16:
-                    return int.from_bytes(self.buffer[offset:offset+2], "big")
+                    return (buffer[offset] << 8) | buffer[offset+1]
                 elif type == INT32:
-                    return int.from_bytes(self.buffer[offset:offset+4], "big")
+                    return int.from_bytes(buffer[offset:offset+4], "big")
                 elif type == STRING:
-                    size = int.from_bytes(self.buffer[offset:offset+4], "big")
-                    return self.buffer[offset+4:offset+4+size].decode("utf-8")
+                    size = int.from_bytes(buffer[offset:offset+4], "big")
+                    return buffer[offset+4:offset+4+size].decode("utf-8")
                 elif type == BYTES:
-                    size = int.from_bytes(self.buffer[offset:offset+4], "big")
-                    return self.buffer[offset+4:offset+4+size]
+                    size = int.from_bytes(buffer[offset:offset+4], "big")
+                    return buffer[offset+4:offset+4+size]
                 elif type == SINT16:
-                    value = int.from_bytes(self.buffer[offset:offset+2], "big")
+                    value = (buffer[offset] << 8) | buffer[offset+1]
                     if value >= 0x8000:
                         value -= 0x10000
                     return value
                 elif type == SINT32:
-                    value = int.from_bytes(self.buffer[offset:offset+4], "big")
+                    value = int.from_bytes(buffer[offset:offset+4], "big")
                     if value >= 0x80000000:
                         value -= 0x100000000
                     return value
@@ -93,6 +96,8 @@ class BarrierMessage:
                         value += 0x100000000
                     self.buffer[offset:offset+4] = value.to_bytes(4, "big")
                 return
+        # Only reached where __setattr__ is dispatched for every assignment, e.g. CPython
+        object.__setattr__(self, name, value)
 
     def dump(self):
         print(self.__class__.__name__, end="(")
@@ -367,8 +372,8 @@ class DMouseRelMove(BarrierMessage):
     """
     CMD = "DMRM"
     FIELD_DEF = [
-        ("x", INT16, 0),
-        ("y", INT16, 2),
+        ("x", SINT16, 0),
+        ("y", SINT16, 2),
     ]
 
     def __init__(self, **fields):
@@ -544,51 +549,125 @@ MESSAGES = {
     "EBAD": EBad,
 }
 
+def command_key(buffer):
+    """
+    Pack the 4 ASCII bytes of a command into a small int, so decoding doesn't allocate a str.
+    """
+    return (buffer[0] << 21) | (buffer[1] << 14) | (buffer[2] << 7) | buffer[3]
+
+# One preallocated instance per message type, decode_message reuses them,
+# so a decoded message is only valid until the next message of the same type.
+MESSAGE_POOL = {}
+for t in MESSAGES:
+    MESSAGE_POOL[command_key(t.encode("utf-8"))] = MESSAGES[t]()
+
 def decode_message(buffer):
-    t = buffer[0:4].decode("utf-8")
-    msg = MESSAGES[t]()
+    msg = MESSAGE_POOL[command_key(buffer)]
     msg.buffer = buffer
     return msg
 
+# Socket timeout in seconds while tracing and idle, the dump button is checked after every read
+TRACE_BUTTON_POLL = 0.05
+
 class BarrierClient:
-    def __init__(self, server, port, width, height, name):
+    def __init__(self, servers, port, width, height, name, scale=1.0, homing_reports=0, trace_records=0, trace_path=None):
         self.seq = 0
         self.width = width
         self.height = height
         self.x = width // 2
         self.y = height // 2
+        # Host pixels moved per HID mouse count, compensates pointer acceleration,
+        # kept in 1/256 fixed point as floats are heap allocated on the device.
+        self.scale = max(1, int(scale * 256))
+        # Sub-count remainders carried over so rounding doesn't accumulate into drift
+        self.rem_x = 0
+        self.rem_y = 0
+        if homing_reports <= 0:
+            # Enough max-delta reports to cross the whole screen, plus some margin
+            homing_reports = max(width, height) // max(1, int(utils.MAX_MOUSE_DELTA * scale)) + 2
+        self.homing_reports = homing_reports
         self.name = name
         self.size_buf = bytearray(4)
-        self.socket = utils.connect(host=server, port=port)
+        # Preallocated so steady-state message handling doesn't touch the heap
+        self.rx_buf = bytearray(utils.MAX_BUFFER)
+        self.tx_size_buf = bytearray(4)
+        self.noop = CNoop()
+        self.message_count = 0
+        self.reads = 0
+        # Resumable read state, the socket times out while HID reports are pending
+        self.rx_size = -1
+        self.rx_received = 0
+        self.poll_timeout = utils.HID_POLL_MS / 1000
+        self.timeout = None
+        self.trace = event_trace.TraceRecorder(trace_records) if trace_records > 0 else None
+        utils.scheduler.trace = self.trace
+        # While tracing the socket never blocks for long, so the dump button is noticed when idle too
+        self.idle_timeout = TRACE_BUTTON_POLL if self.trace is not None else None
+        self.trace_path = trace_path
+        if isinstance(servers, str):
+            servers = [servers]
+        # The Hello message has already been read while racing the servers
+        self.socket, hello = utils.connect_any(hosts=servers, port=port)
+        self.hello = decode_message(hello)
     
     def run(self):
+        if self.hello is not None:
+            self.on_message(self.hello)
+            self.hello = None
         while True:
+            # Only wait for the next poll slot if reports are pending, block otherwise unless tracing
+            timeout = self.poll_timeout if utils.scheduler.poll() else self.idle_timeout
+            if timeout is not self.timeout:
+                self.socket.settimeout(timeout)
+                self.timeout = timeout
             message = self.read_message()
+            # Timed out reads allocate too, so they count towards the heap check
+            self.reads += 1
+            if self.reads == utils.GC_CHECK_READS:
+                self.reads = 0
+                utils.check_heap()
+            if self.trace is not None and utils.button_pressed():
+                self.trace.dump(self.trace_path)
             if message is None:
                 continue
+            self.message_count += 1
             # print("Received message", end=": ")
             # message.dump()
+            if self.trace is None:
+                self.on_message(message)
+                continue
+            self.trace.record(event_trace.STAGE_DISPATCH, message.buffer)
             self.on_message(message)
+            self.trace.record(event_trace.STAGE_EMIT, message.buffer)
     
     def on_message(self, message):
         if isinstance(message, Hello):
             self.send_message(HelloBack(major = message.major, minor = message.minor, name=self.name))
         elif isinstance(message, CKeepAlive):
-            self.send_message(CNoop())
+            self.send_message(self.noop)
+            # Nothing but this keep alive since the last one, a good time to collect garbage
+            utils.idle_gc(self.message_count == 1)
+            self.message_count = 0
         elif isinstance(message, QInfo):
             self.send_message(self.get_info())
         elif isinstance(message, CEnter):
             utils.set_led(0, 128, 0) # Light green
             self.seq = message.seq
+            self.home_mouse()
             self.move_mouse(message.x, message.y)
         elif isinstance(message, CLeave):
             utils.set_led(0, 32, 0) # Dim green
+            utils.idle_gc(True)
         elif isinstance(message, DMouseMove):
             self.move_mouse(message.x, message.y)
         elif isinstance(message, DMouseRelMove):
             self.move_mouse(self.x + message.x, self.y + message.y)
         elif isinstance(message, DMouseWheel):
-            pass
+            utils.mouse_wheel(message.x, message.y)
+        elif isinstance(message, DMouseDown):
+            utils.mouse_down(message.button)
+        elif isinstance(message, DMouseUp):
+            utils.mouse_up(message.button)
         elif isinstance(message, DKeyDown):
             self.send_key(message.keyid, message.modifier, message.button,)
         elif isinstance(message, DKeyRepeat):
@@ -601,25 +680,72 @@ class BarrierClient:
         return DInfo(x_origin=0, y_origin=0, width=self.width, height=self.height, x=self.x, y=self.y)
     
     def send_message(self, message):
-        print("Sending message", end=": ")
-        message.dump()
-        utils.write_int(self.socket, len(message))
+        if utils.DEBUG:
+            print("Sending message", end=": ")
+            message.dump()
+        utils.write_int(self.socket, len(message), self.tx_size_buf)
         utils.write_buf(self.socket, message.buffer)
 
     def read_message(self):
-        size = utils.read_int(self.socket)
-        buffer = utils.read_buf(self.socket, size)
-        if buffer is None:
-            return None
-        return decode_message(buffer)
+        """
+        Read the next message, returns None if it's not complete yet, the read resumes on next call.
+        """
+        if self.rx_size < 0:
+            received = utils.recv_some(self.socket, self.size_buf, self.rx_received, 4)
+            if received > 0 and self.rx_received == 0 and self.trace is not None:
+                # Partial reads and stalls count towards the read stage
+                self.trace.start()
+            self.rx_received += received
+            if self.rx_received < 4:
+                return None
+            self.rx_size = int.from_bytes(self.size_buf, "big")
+            self.rx_received = 0
+            if self.rx_size > utils.MAX_BUFFER:
+                # Drain the oversized message in blocking mode
+                self.socket.settimeout(None)
+                self.timeout = None
+                utils.read_buf(self.socket, self.rx_size, self.rx_buf)
+                self.rx_size = -1
+                return None
+        if self.rx_received < self.rx_size:
+            self.rx_received += utils.recv_some(self.socket, self.rx_buf, self.rx_received, self.rx_size)
+            if self.rx_received < self.rx_size:
+                return None
+        self.rx_size = -1
+        self.rx_received = 0
+        buffer = self.rx_buf
+        if self.trace is None:
+            return decode_message(buffer)
+        self.trace.begin(buffer)
+        message = decode_message(buffer)
+        self.trace.record(event_trace.STAGE_DECODE, buffer)
+        return message
     
+    def home_mouse(self):
+        """
+        Slam the cursor into the top-left corner so the position is known again.
+        """
+        utils.home_mouse(self.homing_reports)
+        self.x = 0
+        self.y = 0
+        self.rem_x = 0
+        self.rem_y = 0
+
     def move_mouse(self, x, y):
-        utils.move_mouse_rel(x-self.x, y-self.y)
+        dx = (x - self.x) * 256 + self.rem_x
+        dy = (y - self.y) * 256 + self.rem_y
+        ix = dx // self.scale
+        iy = dy // self.scale
+        self.rem_x = dx - ix * self.scale
+        self.rem_y = dy - iy * self.scale
+        if ix or iy:
+            utils.move_mouse_rel(ix, iy)
         self.x = x
         self.y = y
     
     def send_key(self, id, modifier, button, down=True):
-        print("Key", id, "button", button, "pressed" if down else "released")
+        if utils.DEBUG:
+            print("Key", id, "button", button, "pressed" if down else "released")
         if down:
             utils.key_down(id, modifier, button)
         else:
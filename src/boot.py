@@ -0,0 +1,56 @@
+"""
+Runs before USB is set up, replaces the default mouse with one that also reports horizontal scroll.
+Changes only take effect after a hard reset.
+"""
+
+import usb_hid
+
+# The default CircuitPython mouse, 5 buttons, x, y and wheel, plus AC Pan
+MOUSE_REPORT_DESCRIPTOR = bytes((
+    0x05, 0x01,         # Usage Page (Generic Desktop)
+    0x09, 0x02,         # Usage (Mouse)
+    0xA1, 0x01,         # Collection (Application)
+    0x85, 0x02,         #   Report ID (2)
+    0x09, 0x01,         #   Usage (Pointer)
+    0xA1, 0x00,         #   Collection (Physical)
+    0x05, 0x09,         #     Usage Page (Button)
+    0x19, 0x01,         #     Usage Minimum (Button 1)
+    0x29, 0x05,         #     Usage Maximum (Button 5)
+    0x15, 0x00,         #     Logical Minimum (0)
+    0x25, 0x01,         #     Logical Maximum (1)
+    0x95, 0x05,         #     Report Count (5)
+    0x75, 0x01,         #     Report Size (1)
+    0x81, 0x02,         #     Input (Data, Variable, Absolute)
+    0x95, 0x01,         #     Report Count (1)
+    0x75, 0x03,         #     Report Size (3)
+    0x81, 0x01,         #     Input (Constant)
+    0x05, 0x01,         #     Usage Page (Generic Desktop)
+    0x09, 0x30,         #     Usage (X)
+    0x09, 0x31,         #     Usage (Y)
+    0x09, 0x38,         #     Usage (Wheel)
+    0x15, 0x81,         #     Logical Minimum (-127)
+    0x25, 0x7F,         #     Logical Maximum (127)
+    0x75, 0x08,         #     Report Size (8)
+    0x95, 0x03,         #     Report Count (3)
+    0x81, 0x06,         #     Input (Data, Variable, Relative)
+    0x05, 0x0C,         #     Usage Page (Consumer)
+    0x0A, 0x38, 0x02,   #     Usage (AC Pan)
+    0x15, 0x81,         #     Logical Minimum (-127)
+    0x25, 0x7F,         #     Logical Maximum (127)
+    0x75, 0x08,         #     Report Size (8)
+    0x95, 0x01,         #     Report Count (1)
+    0x81, 0x06,         #     Input (Data, Variable, Relative)
+    0xC0,               #   End Collection
+    0xC0,               # End Collection
+))
+
+mouse = usb_hid.Device(
+    report_descriptor=MOUSE_REPORT_DESCRIPTOR,
+    usage_page=0x01,
+    usage=0x02,
+    report_ids=(2,),
+    in_report_lengths=(5,),
+    out_report_lengths=(0,),
+)
+
+usb_hid.enable((usb_hid.Device.KEYBOARD, mouse, usb_hid.Device.CONSUMER_CONTROL))
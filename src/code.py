@@ -9,9 +9,13 @@ initialize()
 # Connect to the WiFi network
 connect_to_wifi()
 
-import usb_hid
-from adafruit_hid.mouse import Mouse
-mouse = Mouse(usb_hid.devices)
-
-client = barrier.BarrierClient(server = secrets["SERVER"], port = secrets["PORT"], width = 2560, height = 1440, name = secrets["SCREEN_NAME"])
+client = barrier.BarrierClient(servers = secrets.get("SERVERS") or [secrets["SERVER"]],
+                               port = secrets["PORT"],
+                               width = secrets.get("SCREEN_WIDTH", 2560),
+                               height = secrets.get("SCREEN_HEIGHT", 1440),
+                               name = secrets["SCREEN_NAME"],
+                               scale = secrets.get("MOUSE_SCALE", 1.0),
+                               homing_reports = secrets.get("HOMING_REPORTS", 0),
+                               trace_records = secrets.get("TRACE_RECORDS", 0),
+                               trace_path = secrets.get("TRACE_PATH"))
 client.run()
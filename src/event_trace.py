@@ -0,0 +1,133 @@
+"""
+Binary event trace recorder.
+Every message is recorded at each stage it goes through into a fixed RAM ring,
+which can be dumped to flash or over serial, and analyzed by `trace_analyze.py` on the host.
+"""
+
+import binascii
+import supervisor
+
+# Stages
+STAGE_READ = 0
+STAGE_DECODE = 1
+STAGE_DISPATCH = 2
+STAGE_EMIT = 3      # Handed over to the HID report scheduler
+STAGE_SEND = 4      # HID report sent by the scheduler, recorded with the report as payload
+
+# Record layout, little endian:
+#   ticks_ms (4), command (4), stage (1), seq (1), first 6 payload bytes (6)
+RECORD_SIZE = 16
+PAYLOAD_SIZE = 6
+
+# Dump header: magic (4), version (1), record size (1), count (2), ticks_ms at dump time (4)
+MAGIC = b"BTRC"
+VERSION = 1
+HEADER_SIZE = 12
+
+class TraceRecorder:
+    """
+    Fixed size ring of trace records, recording doesn't allocate.
+    """
+    def __init__(self, records):
+        self.capacity = records
+        self.ring = bytearray(records * RECORD_SIZE)
+        self.pos = 0
+        self.count = 0
+        self.seq = 0
+        self.started = 0
+
+    def start(self):
+        """
+        Note the time the next message starts arriving, it's only recorded once read completely.
+        """
+        self.started = supervisor.ticks_ms()
+
+    def begin(self, buffer):
+        """
+        Start tracing a newly read message, stamped with the time it started arriving.
+        """
+        self.seq = (self.seq + 1) & 0xFF
+        self.record(STAGE_READ, buffer, self.started)
+
+    def record(self, stage, buffer, ticks=None):
+        """
+        Record the current message at the given stage, now unless `ticks` is given.
+        """
+        ring = self.ring
+        o = self.pos * RECORD_SIZE
+        t = supervisor.ticks_ms() if ticks is None else ticks
+        ring[o] = t & 0xFF
+        ring[o+1] = (t >> 8) & 0xFF
+        ring[o+2] = (t >> 16) & 0xFF
+        ring[o+3] = (t >> 24) & 0xFF
+        ring[o+4] = buffer[0]
+        ring[o+5] = buffer[1]
+        ring[o+6] = buffer[2]
+        ring[o+7] = buffer[3]
+        ring[o+8] = stage
+        ring[o+9] = self.seq
+        # Payload beyond the message is left over from earlier messages, it's never decoded
+        n = min(PAYLOAD_SIZE, len(buffer) - 4)
+        for i in range(n):
+            ring[o+10+i] = buffer[4+i]
+        for i in range(n, PAYLOAD_SIZE):
+            ring[o+10+i] = 0
+        self.pos += 1
+        if self.pos == self.capacity:
+            self.pos = 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def header(self):
+        t = supervisor.ticks_ms()
+        header = bytearray(HEADER_SIZE)
+        header[0:4] = MAGIC
+        header[4] = VERSION
+        header[5] = RECORD_SIZE
+        header[6:8] = self.count.to_bytes(2, "little")
+        header[8:12] = t.to_bytes(4, "little")
+        return header
+
+    def records(self):
+        """
+        Yield the recorded chunks, oldest first.
+        """
+        ring = memoryview(self.ring)
+        if self.count < self.capacity:
+            yield ring[:self.count * RECORD_SIZE]
+        else:
+            yield ring[self.pos * RECORD_SIZE:]
+            yield ring[:self.pos * RECORD_SIZE]
+
+    def dump(self, path=None):
+        """
+        Dump the trace into a file if a path is given, fall back to serial if the filesystem is read only.
+        """
+        if path:
+            try:
+                self.dump_to_file(path)
+                return
+            except OSError as e:
+                print("Failed to dump trace to %s, %s" % (path, e))
+        self.dump_to_serial()
+
+    def dump_to_file(self, path):
+        """
+        Dump the trace into a file, the filesystem needs to be writable, see `storage.remount`.
+        """
+        with open(path, "wb") as f:
+            f.write(self.header())
+            for chunk in self.records():
+                f.write(chunk)
+        print("Trace dumped to %s, %d records" % (path, self.count))
+
+    def dump_to_serial(self):
+        """
+        Print the trace as base64 lines between markers, `trace_analyze.py` can read the captured log.
+        """
+        print("-----BEGIN TRACE-----")
+        print(binascii.b2a_base64(self.header()).decode("utf-8"), end="")
+        for chunk in self.records():
+            for o in range(0, len(chunk), 48):
+                print(binascii.b2a_base64(chunk[o:o+48]).decode("utf-8"), end="")
+        print("-----END TRACE-----")
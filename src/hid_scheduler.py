@@ -0,0 +1,250 @@
+"""
+USB poll aligned HID report scheduler.
+Sending a report blocks until the host polls the endpoint, so reports are queued here and
+at most one report per endpoint is sent every poll interval. State changes arriving in between
+are merged into the pending report, unless that would lose a press or release edge or reorder presses.
+"""
+
+import event_trace
+import supervisor
+
+# supervisor.ticks_ms wraps around at 2**29
+TICKS_PERIOD = 1 << 29
+
+MAX_DELTA = 127
+
+def _contains(report, start, end, key):
+    for n in range(start, end):
+        if report[n] == key:
+            return True
+    return False
+
+def _copy(dst, d, src, s, length):
+    # Slice assignment would allocate a slice object
+    for n in range(length):
+        dst[d+n] = src[s+n]
+
+def _keyboard_loses_edge(prev, p, tail, t, new):
+    """
+    Whether replacing the pending keyboard report `tail` with `new` drops an edge or the order
+    of key presses, `prev` is the report before it, `p` and `t` are the offsets in their buffers.
+    """
+    # Modifier pressed then released, or released then pressed again
+    if (tail[t] & ~prev[p] & ~new[0]) | (prev[p] & ~tail[t] & new[0]):
+        return True
+    for n in range(2, 8):
+        key = tail[t+n]
+        # A key pressed in the pending report must reach the host before any later press,
+        # the host reads the keys of a report in slot order
+        if key and not _contains(prev, p+2, p+8, key):
+            return True
+        key = prev[p+n]
+        if key and not _contains(tail, t+2, t+8, key) and _contains(new, 2, 8, key):
+            return True
+    return False
+
+class ReportScheduler:
+    """
+    Keeps the pending keyboard, mouse and consumer reports, nothing is allocated after construction.
+    """
+    def __init__(self, keyboard_device, mouse_device, consumer_device, interval_ms=8, queue=16, mouse_report_length=4):
+        self.keyboard_device = keyboard_device
+        self.mouse_device = mouse_device
+        self.consumer_device = consumer_device
+        self.interval = interval_ms
+        self.queue = queue
+        # Optional event_trace.TraceRecorder, sent reports are recorded under a pseudo command
+        self.trace = None
+
+        # Keyboard, full 8 byte reports
+        self.kbd_sent = bytearray(8)
+        self.kbd_queue = bytearray(8 * queue)
+        self.kbd_head = 0
+        self.kbd_count = 0
+        self.kbd_last = 0
+        self.kbd_trace = bytearray(b"HKBD" + bytes(8))
+
+        # Mouse, [buttons, dx, dy, wheel, pan] per entry, motion accumulates into the last entry.
+        # Pan is only reported if the mouse descriptor has it, see boot.py.
+        self.mouse_report = bytearray(mouse_report_length)
+        self.mouse_buttons = 0
+        self.mouse_sent = 0
+        self.mouse_queue = [0] * (5 * queue)
+        self.mouse_head = 0
+        self.mouse_count = 0
+        self.mouse_last = 0
+        # Nothing more is merged into the last entry once closed
+        self.mouse_closed = False
+        self.mouse_trace = bytearray(b"HMOU" + bytes(mouse_report_length))
+
+        # Consumer control, one usage per report
+        self.consumer_report = bytearray(2)
+        self.consumer_sent = 0
+        self.consumer_queue = [0] * queue
+        self.consumer_head = 0
+        self.consumer_count = 0
+        self.consumer_last = 0
+        self.consumer_trace = bytearray(b"HCON" + bytes(2))
+
+    def _trace(self, buffer, report):
+        _copy(buffer, 4, report, 0, len(report))
+        self.trace.record(event_trace.STAGE_SEND, buffer)
+
+    def _due(self, last):
+        return (supervisor.ticks_ms() - last) % TICKS_PERIOD >= self.interval
+
+    def keyboard(self, report):
+        """
+        Submit the new keyboard state.
+        """
+        q = self.kbd_queue
+        if self.kbd_count > 0:
+            t = ((self.kbd_head + self.kbd_count - 1) % self.queue) * 8
+            if self.kbd_count > 1:
+                prev = q
+                p = ((self.kbd_head + self.kbd_count - 2) % self.queue) * 8
+            else:
+                prev = self.kbd_sent
+                p = 0
+            if not _keyboard_loses_edge(prev, p, q, t, report):
+                _copy(q, t, report, 0, 8)
+                return
+        elif self.kbd_sent == report:
+            return
+        if self.kbd_count == self.queue:
+            # Queue is full, wait for the host rather than drop an edge
+            self._send_keyboard()
+        t = ((self.kbd_head + self.kbd_count) % self.queue) * 8
+        _copy(q, t, report, 0, 8)
+        self.kbd_count += 1
+
+    def _send_keyboard(self):
+        _copy(self.kbd_sent, 0, self.kbd_queue, self.kbd_head * 8, 8)
+        self.keyboard_device.send_report(self.kbd_sent)
+        if self.trace is not None:
+            self._trace(self.kbd_trace, self.kbd_sent)
+        self.kbd_head = (self.kbd_head + 1) % self.queue
+        self.kbd_count -= 1
+        self.kbd_last = supervisor.ticks_ms()
+
+    def mouse_move(self, dx, dy, wheel=0, pan=0):
+        """
+        Accumulate relative motion and scrolling into the pending mouse report.
+        """
+        if self.mouse_count == 0 or self.mouse_closed:
+            self._append_mouse(self.mouse_buttons)
+        t = ((self.mouse_head + self.mouse_count - 1) % self.queue) * 5
+        q = self.mouse_queue
+        q[t+1] += dx
+        q[t+2] += dy
+        q[t+3] += wheel
+        if len(self.mouse_report) > 4:
+            q[t+4] += pan
+
+    def mouse_close(self):
+        """
+        Close the pending mouse report, later motion and button changes start a new one.
+        """
+        self.mouse_closed = self.mouse_count > 0
+
+    def mouse_press(self, buttons):
+        """
+        Submit the new mouse button state.
+        """
+        self.mouse_buttons = buttons
+        if self.mouse_count > 0 and not self.mouse_closed:
+            q = self.mouse_queue
+            t = ((self.mouse_head + self.mouse_count - 1) % self.queue) * 5
+            if self.mouse_count > 1:
+                prev = q[((self.mouse_head + self.mouse_count - 2) % self.queue) * 5]
+            else:
+                prev = self.mouse_sent
+            tail = q[t]
+            # Motion pending from before the change must still be sent with the old buttons
+            moving = q[t+1] or q[t+2] or q[t+3] or q[t+4]
+            if not moving and not ((tail & ~prev & ~buttons) | (prev & ~tail & buttons)):
+                q[t] = buttons
+                return
+        elif self.mouse_count == 0 and self.mouse_sent == buttons:
+            return
+        self._append_mouse(buttons)
+
+    def _append_mouse(self, buttons):
+        if self.mouse_count == self.queue:
+            # Queue is full, wait for the host rather than drop an edge
+            while self.mouse_count == self.queue:
+                self._send_mouse()
+        q = self.mouse_queue
+        t = ((self.mouse_head + self.mouse_count) % self.queue) * 5
+        for n in range(5):
+            q[t+n] = 0
+        q[t] = buttons
+        self.mouse_count += 1
+        self.mouse_closed = False
+
+    def _send_mouse(self):
+        q = self.mouse_queue
+        h = self.mouse_head * 5
+        report = self.mouse_report
+        report[0] = q[h]
+        for n in range(1, len(report)):
+            # Large motion is split over several polls, the rest stays in the entry
+            delta = max(-MAX_DELTA, min(MAX_DELTA, q[h+n]))
+            q[h+n] -= delta
+            report[n] = delta & 0xFF
+        self.mouse_device.send_report(report)
+        if self.trace is not None:
+            self._trace(self.mouse_trace, report)
+        self.mouse_sent = q[h]
+        self.mouse_last = supervisor.ticks_ms()
+        if q[h+1] == 0 and q[h+2] == 0 and q[h+3] == 0 and q[h+4] == 0:
+            self.mouse_head = (self.mouse_head + 1) % self.queue
+            self.mouse_count -= 1
+
+    def consumer(self, usage):
+        """
+        Submit the new consumer control usage, 0 releases.
+        """
+        q = self.consumer_queue
+        if self.consumer_count > 0:
+            t = (self.consumer_head + self.consumer_count - 1) % self.queue
+            if self.consumer_count > 1:
+                prev = q[(self.consumer_head + self.consumer_count - 2) % self.queue]
+            else:
+                prev = self.consumer_sent
+            if q[t] == usage:
+                return
+            if q[t] == prev:
+                q[t] = usage
+                return
+        elif self.consumer_sent == usage:
+            return
+        if self.consumer_count == self.queue:
+            # Queue is full, wait for the host rather than drop an edge
+            self._send_consumer()
+        q[(self.consumer_head + self.consumer_count) % self.queue] = usage
+        self.consumer_count += 1
+
+    def _send_consumer(self):
+        usage = self.consumer_queue[self.consumer_head]
+        self.consumer_report[0] = usage & 0xFF
+        self.consumer_report[1] = (usage >> 8) & 0xFF
+        self.consumer_device.send_report(self.consumer_report)
+        if self.trace is not None:
+            self._trace(self.consumer_trace, self.consumer_report)
+        self.consumer_sent = usage
+        self.consumer_head = (self.consumer_head + 1) % self.queue
+        self.consumer_count -= 1
+        self.consumer_last = supervisor.ticks_ms()
+
+    def poll(self):
+        """
+        Send at most one due report per endpoint, returns whether reports are still pending.
+        """
+        if self.kbd_count > 0 and self._due(self.kbd_last):
+            self._send_keyboard()
+        if self.mouse_count > 0 and self._due(self.mouse_last):
+            self._send_mouse()
+        if self.consumer_count > 0 and self._due(self.consumer_last):
+            self._send_consumer()
+        return self.kbd_count > 0 or self.mouse_count > 0 or self.consumer_count > 0
@@ -1,3 +1,4 @@
+from secrets import secrets
 
 table = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x2C\x1E\x00\x20\x21\x22\x24\x00\x26\x27\x25\x2E\x36\x2D\x37\x38\x27\x1E\x1F\x20\x21\x22\x23\x24\x25\x26\x00\x00\x00\x2E\x00\x38\x1F\x04\x05\x06\x07\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1A\x1B\x1C\x00\x2F\x31\x30\x23\x2D\x35\x04\x05\x06\x07\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1A\x1B\x1C\x00\x2F\x31\x30\x35\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 ext_tab = b'\x00\x00\x00\x00\x00\x00\x00\x00\x2A\x2B\x00\x9C\x00\x9E\x00\x00\x00\x00\x00\x48\x47\x9A\x00\x00\x00\x00\x00\x29\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x4A\x50\x52\x4F\x51\x4B\x4E\x4D\x00\x00\x00\x00\x00\x00\x00\x00\x77\x46\x74\x49\x00\x7A\x00\x76\x7E\x9B\x75\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x53\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x58\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x55\x57\x00\x56\x63\x54\x62\x59\x5A\x5B\x5C\x5D\x5E\x5F\x60\x61\x00\x00\x00\x67\x3A\x3B\x3C\x3D\x3E\x3F\x40\x41\x42\x43\x44\x45\x68\x69\x6A\x6B\x6C\x6D\x6E\x6F\x70\x71\x72\x73\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xE1\xE5\xE0\xE4\x39\x00\x00\x00\xE2\xE6\xE3\xE7\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x4C'
@@ -13,4 +14,40 @@ def synergy_to_hid(id):
         return ext_tab[id - 0xEF00]
     if id >=0xE000 and id <= 0xE100:
         return ext_tab[id - 0xE000]
-    return 0
\ No newline at end of file
+    return 0
+
+# Consumer control usages for kKeyAudioMute to kKeyAudioPlay, 0xE0AD-0xE0B3
+consumer_tab = b'\xE2\xEA\xE9\xB5\xB6\xB7\xCD'
+
+def media_to_consumer(id):
+    """
+    Translate media KeyIDs to consumer control usages, 0 if not a media key.
+    """
+    if id >= 0xE0AD and id <= 0xE0B3:
+        return consumer_tab[id - 0xE0AD]
+    return 0
+
+# Layout flags, see `genlayout.py`
+LAYOUT_SHIFT = 0x01
+LAYOUT_ALTGR = 0x02
+LAYOUT_ANY_SHIFT = 0x04     # Shift doesn't change the character
+LAYOUT_DEAD = 0x80
+
+layout = __import__("layouts." + secrets.get("LAYOUT", "us"), None, None, ["pages"])
+layout_pages = layout.pages
+layout_data = layout.data
+layout_dead = layout.dead
+
+def unicode_to_hid(id):
+    """
+    Translate a Unicode KeyID to HID keycode and layout flags on the host layout,
+    packed as `flags << 8 | keycode`, 0 if the layout can't type it.
+    If `LAYOUT_DEAD` is set, the keycode is the index of the dead key sequence in `layout_dead`.
+    """
+    if id > 0xFFFF:
+        return 0
+    page = layout_pages[id >> 8]
+    if page == 0:
+        return 0
+    o = ((page - 1) << 9) | ((id & 0xFF) << 1)
+    return (layout_data[o+1] << 8) | layout_data[o]
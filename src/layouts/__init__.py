@@ -0,0 +1,3 @@
+"""
+Keyboard layout tables generated by `genlayout.py`, one module per host layout.
+"""
@@ -2,6 +2,26 @@ secrets = {
     "SSID": "YOUR_WIFI_SSID",
     "PASSWORD": "YOUR_WIFI_PASSWORD",
     "SERVER": "BARRIER_SERVER_ADDRESS",
+    # Optional, candidate servers raced in parallel, overrides "SERVER"
+    # "SERVERS": ["BARRIER_SERVER_ADDRESS", "BACKUP_SERVER_ADDRESS"],
     "PORT": 24800,
     "SCREEN_NAME": "ESPARRIER",
+    # Keyboard layout of the host, one of the modules under layouts/, e.g. "us", "gb", "de", "fr"
+    "LAYOUT": "us",
+    "SCREEN_WIDTH": 2560,
+    "SCREEN_HEIGHT": 1440,
+    # Host pixels moved per HID mouse count, raise it if the cursor overshoots because of pointer acceleration
+    "MOUSE_SCALE": 1.0,
+    # USB poll interval of the HID endpoints in ms, at most one report per endpoint is sent per interval
+    "HID_POLL_MS": 8,
+    # Only collect garbage when the link is idle, avoids hitches during mouse sweeps
+    "IDLE_GC": True,
+    # Print every key and outgoing message, allocates on the hot path
+    "DEBUG": False,
+    # Number of trace records kept in RAM, 16 bytes each, 0 disables tracing
+    "TRACE_RECORDS": 0,
+    # Optional, the trace is dumped here when the button is pressed, falls back to serial if not writable
+    # "TRACE_PATH": "/trace.bin",
+    # Optional, number of max-delta reports used to home the cursor, 0 means derive from the screen size
+    # "HOMING_REPORTS": 0,
 }
\ No newline at end of file
@@ -1,23 +1,63 @@
 import board
+import errno
+import gc
+import microcontroller
 import neopixel_write
+import time
 import digitalio
 import wifi
 import socketpool
 import usb_hid
-from adafruit_hid.keyboard import Keyboard
-from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
-from adafruit_hid.keycode import Keycode
-from adafruit_hid.mouse import Mouse
+from adafruit_hid import find_device
 
-from key_codes import synergy_to_hid
+from hid_scheduler import ReportScheduler
+from key_codes import synergy_to_hid, unicode_to_hid, media_to_consumer, layout_dead, LAYOUT_SHIFT, LAYOUT_ALTGR, LAYOUT_ANY_SHIFT, LAYOUT_DEAD
 from secrets import secrets
 
 LED = None
+BUTTON = None
 POOL = None
 MAX_BUFFER = 1024
+CONNECT_TIMEOUT = 10
+MAX_MOUSE_DELTA = 127
+# At most one report per endpoint is sent per interval, should match the USB poll interval
+HID_POLL_MS = secrets.get("HID_POLL_MS", 8)
+DEBUG = secrets.get("DEBUG", False)
 
-mouse = Mouse(usb_hid.devices)
-keyboard = Keyboard(usb_hid.devices)
+# Garbage collection only runs in idle gaps, or when free memory drops below the low water mark
+IDLE_GC = secrets.get("IDLE_GC", True)
+GC_LOW_WATER = 16 * 1024
+# Reads between heap checks if the collector is disabled, gc.mem_free walks the whole heap.
+# Reads that time out while HID reports are pending count too, each one allocates an OSError.
+GC_CHECK_READS = 64
+
+# Layout of the non-volatile memory
+NVM_SERVER_ORDER = 0    # magic, count, then one index byte per server
+NVM_SERVER_ORDER_MAGIC = 0xB5
+MAX_SERVERS = 8
+
+keyboard_device = find_device(usb_hid.devices, usage_page=0x1, usage=0x06)
+mouse_device = find_device(usb_hid.devices, usage_page=0x1, usage=0x02)
+consumer_device = find_device(usb_hid.devices, usage_page=0x0C, usage=0x01)
+
+def probe_mouse_report_length():
+    """
+    The mouse set up by boot.py also reports horizontal scroll, fall back to the default mouse without it.
+    """
+    report = bytearray(5)
+    try:
+        try:
+            mouse_device.send_report(report)
+        except OSError:
+            # USB may not be ready yet right after boot, retry once like adafruit_hid does
+            time.sleep(1)
+            mouse_device.send_report(report)
+    except ValueError:
+        return 4
+    return 5
+
+scheduler = ReportScheduler(keyboard_device, mouse_device, consumer_device, HID_POLL_MS,
+                            mouse_report_length=probe_mouse_report_length())
 
 server_button_state = bytearray(512)
 
@@ -31,6 +71,79 @@ def initialize():
     LED = digitalio.DigitalInOut(board.NEOPIXEL)
     LED.direction = digitalio.Direction.OUTPUT
 
+    # Initialize the on-board button, if any.
+    global BUTTON
+    pin = getattr(board, "BTN", None) or getattr(board, "BUTTON", None)
+    if pin is not None:
+        BUTTON = digitalio.DigitalInOut(pin)
+        BUTTON.switch_to_input(pull=digitalio.Pull.UP)
+
+    gc.collect()
+    if IDLE_GC:
+        if hasattr(gc, "threshold"):
+            # Keep the collector as a safety net, but only let it run once the heap is nearly full
+            gc.threshold(max(GC_LOW_WATER, gc.mem_free() - GC_LOW_WATER))
+        else:
+            # A full heap now raises MemoryError instead of collecting, see check_heap
+            gc.disable()
+            gc_disabled[0] = True
+    gc_stats[2] = gc.mem_alloc()
+    gc_stats[3] = time.monotonic()
+
+# [mem_free, allocation rate in bytes/s, mem_alloc at last check, time of last check]
+gc_stats = [0, 0, 0, 0]
+gc_disabled = [False]
+
+def update_gc_stats():
+    """
+    Update the heap telemetry, returns the number of bytes allocated since the last check.
+    """
+    now = time.monotonic()
+    alloc = gc.mem_alloc()
+    allocated = alloc - gc_stats[2]
+    if now > gc_stats[3]:
+        gc_stats[1] = int(allocated / (now - gc_stats[3]))
+    gc_stats[0] = gc.mem_free()
+    gc_stats[2] = alloc
+    gc_stats[3] = now
+    return allocated
+
+def idle_gc(idle):
+    """
+    Collect garbage if the link is idle, or if the heap is running low anyway.
+    """
+    update_gc_stats()
+    if not IDLE_GC:
+        return
+    if idle or gc_stats[0] < GC_LOW_WATER:
+        gc.collect()
+        gc_stats[2] = gc.mem_alloc()
+    if DEBUG:
+        print("Heap: %d bytes free, %d bytes/s allocated" % (gc_stats[0], gc_stats[1]))
+
+def check_heap():
+    """
+    Collect if the heap is running low while the collector is disabled,
+    long bursts without a keep alive would run out of memory otherwise.
+    """
+    if gc_disabled[0] and gc.mem_free() < GC_LOW_WATER:
+        gc.collect()
+        gc_stats[2] = gc.mem_alloc()
+
+button_state = [False]
+
+def button_pressed():
+    """
+    Returns True once every time the on-board button is pressed.
+    """
+    if BUTTON is None:
+        return False
+    # The button is active low
+    pressed = not BUTTON.value
+    was_pressed = button_state[0]
+    button_state[0] = pressed
+    return pressed and not was_pressed
+
 def connect_to_wifi():
     """
     Connect to the WiFi network.
@@ -49,97 +162,364 @@ def set_led(r, g, b):
     pixel_off = bytearray([g, r, b])
     neopixel_write.neopixel_write(LED, pixel_off)
     
-def connect(host, port):
-    print("Connecting to %s:%d" % (host, port))
-    # server_ipv4 = ipaddress.ip_address(POOL.getaddrinfo(host, port)[0][4][0])
-    s = POOL.socket(POOL.AF_INET, POOL.SOCK_STREAM)
-    s.connect((host, port))
-    print("Connected to %s:%d" % (host, port))
+def load_server_order(count):
+    """
+    Load the preferred server order saved in the NVM, fall back to the configured order.
+    """
+    nvm = microcontroller.nvm
+    order = list(range(count))
+    if nvm[NVM_SERVER_ORDER] != NVM_SERVER_ORDER_MAGIC or nvm[NVM_SERVER_ORDER + 1] != count:
+        return order
+    saved = list(nvm[NVM_SERVER_ORDER + 2:NVM_SERVER_ORDER + 2 + count])
+    if sorted(saved) != order:
+        return order
+    return saved
+
+def save_server_order(order):
+    """
+    Save the preferred server order into the NVM, only writes when changed to save flash wear.
+    """
+    nvm = microcontroller.nvm
+    data = bytes([NVM_SERVER_ORDER_MAGIC, len(order)] + order)
+    if nvm[NVM_SERVER_ORDER:NVM_SERVER_ORDER + len(data)] != data:
+        nvm[NVM_SERVER_ORDER:NVM_SERVER_ORDER + len(data)] = data
+
+def connect_any(hosts, port, timeout=CONNECT_TIMEOUT):
+    """
+    Connect to all candidate servers in parallel, the first one that completes
+    the Hello message wins and all others are closed.
+    Returns the connected socket and the Hello message buffer.
+    """
+    hosts = hosts[:MAX_SERVERS]
+    order = load_server_order(len(hosts))
+    pending = []
+    for n in order:
+        print("Connecting to %s:%d" % (hosts[n], port))
+        s = POOL.socket(POOL.AF_INET, POOL.SOCK_STREAM)
+        s.settimeout(0)
+        try:
+            s.connect((hosts[n], port))
+        except OSError as e:
+            if e.errno not in (errno.EINPROGRESS, errno.EAGAIN, errno.ETIMEDOUT):
+                print("Failed to connect to %s:%d, %s" % (hosts[n], port, e))
+                s.close()
+                continue
+        # [index, socket, buffer, received, is_body]
+        pending.append([n, s, bytearray(4), 0, False])
+
+    winner = None
+    hello = None
+    deadline = time.monotonic() + timeout
+    while pending and winner is None and time.monotonic() < deadline:
+        for c in pending:
+            hello = _poll_hello(c)
+            if hello is None:
+                continue
+            if hello is False:
+                print("Lost connection to %s:%d" % (hosts[c[0]], port))
+                c[1].close()
+                pending.remove(c)
+                break
+            winner = c
+            break
+
+    for c in pending:
+        if c is not winner:
+            c[1].close()
+    if winner is None:
+        raise OSError(errno.ETIMEDOUT)
+
+    n, s = winner[0], winner[1]
+    s.settimeout(None)
+    order.remove(n)
+    save_server_order([n] + order)
+    print("Connected to %s:%d" % (hosts[n], port))
     set_led(0, 32, 0)  # Dim Green
-    return s
+    return s, hello
 
-def read_int(sock):
-    return int.from_bytes(read_buf(sock, 4), "big")
+def _poll_hello(candidate):
+    """
+    Read whatever is available from a non-blocking candidate socket.
+    Returns the Hello message buffer once complete, None if still pending, False on error.
+    """
+    s, buffer, received = candidate[1], candidate[2], candidate[3]
+    try:
+        chunk = s.recv_into(memoryview(buffer)[received:], len(buffer) - received)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EINPROGRESS, errno.ETIMEDOUT):
+            return None
+        return False
+    if chunk == 0:
+        # Connection closed by the server
+        return False
+    received += chunk
+    candidate[3] = received
+    if received < len(buffer):
+        return None
+    if candidate[4]:
+        return buffer
+    # Size prefix completed, start reading the message body
+    size = int.from_bytes(buffer, "big")
+    if size > MAX_BUFFER:
+        return False
+    candidate[2] = bytearray(size)
+    candidate[3] = 0
+    candidate[4] = True
+    return None
+
+def recv_some(sock, buffer, start, end):
+    """
+    Receive whatever is available into buffer[start:end], returns 0 if the socket timed out.
+    A timeout allocates the exception, the caller accounts for that, see GC_CHECK_READS.
+    """
+    try:
+        if start == 0:
+            return sock.recv_into(buffer, end)
+        return sock.recv_into(memoryview(buffer)[start:], end - start)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.ETIMEDOUT):
+            return 0
+        raise
 
-def read_buf(sock, length):
-    buffer = bytearray(length)
+def read_buf(sock, length, buffer=None):
+    """
+    Read exactly `length` bytes, into `buffer` if given to avoid allocation.
+    The returned buffer can be longer than `length` in that case.
+    """
     received = 0
     if length > MAX_BUFFER:
         # Message too large, but we still need to drain it.
-        buffer = bytearray(256)
+        if buffer is None:
+            buffer = bytearray(256)
         while received < length:
-            chunk = sock.recv_into(buffer, min(256, length - received))
+            chunk = sock.recv_into(buffer, min(len(buffer), length - received))
             received += chunk
         print("Message length %d is too large, discard the message." % length)
         return None
+    if buffer is None or len(buffer) < length:
+        buffer = bytearray(length)
+    # Most messages arrive in one piece, only slice the buffer for partial reads
+    received = sock.recv_into(buffer, length)
     while received < length:
         chunk = sock.recv_into(memoryview(buffer)[received:], length - received)
         received += chunk
     return buffer
 
-def write_int(sock, value):
-    return write_buf(sock, value.to_bytes(4, "big"))
+def write_int(sock, value, buffer=None):
+    if buffer is None:
+        buffer = bytearray(4)
+    buffer[0] = (value >> 24) & 0xFF
+    buffer[1] = (value >> 16) & 0xFF
+    buffer[2] = (value >> 8) & 0xFF
+    buffer[3] = value & 0xFF
+    return write_buf(sock, buffer)
 
 def write_buf(sock, buffer):
     length = len(buffer)
-    sent = 0
+    sent = sock.send(buffer)
     while sent < length:
-        sent += sock.send(buffer[sent:])
+        sent += sock.send(memoryview(buffer)[sent:])
     return sent
 
 def move_mouse_rel(x, y):
-    mouse.move(x=x, y=y)
-    pass
+    scheduler.mouse_move(x, y)
 
-def mouse_wheel(x, y):
-    pass
+def home_mouse(reports):
+    """
+    Move the cursor to the top-left corner with a bounded number of max-delta reports.
+    """
+    # The slam is an entry of its own, merging other motion into it would leave the cursor short of the corner
+    scheduler.mouse_close()
+    scheduler.mouse_move(-MAX_MOUSE_DELTA * reports, -MAX_MOUSE_DELTA * reports)
+    scheduler.mouse_close()
+
+# HID button bits for Barrier mouse buttons 1 to 5: left, middle, right, back, forward
+MOUSE_BUTTONS = b'\x00\x01\x04\x02\x08\x10'
+WHEEL_DELTA = 120
+
+mouse_buttons = bytearray(1)
+# Scroll amounts less than a notch, [vertical, horizontal]
+wheel_remainder = [0, 0]
 
 def mouse_down(button):
-    if button==1:
-        mouse.press(Mouse.LEFT_BUTTON)
-    elif button==2:
-        mouse.press(Mouse.MIDDLE_BUTTON)
-    elif button==3:
-        mouse.press(Mouse.RIGHT_BUTTON)
-    else:
+    if button < 1 or button >= len(MOUSE_BUTTONS):
         print("Unknown mouse button: %d" % button)
+        return
+    mouse_buttons[0] |= MOUSE_BUTTONS[button]
+    scheduler.mouse_press(mouse_buttons[0])
 
 def mouse_up(button):
-    if button==1:
-        mouse.release(Mouse.LEFT_BUTTON)
-    elif button==2:
-        mouse.release(Mouse.MIDDLE_BUTTON)
-    elif button==3:
-        mouse.release(Mouse.RIGHT_BUTTON)
-    else:
+    if button < 1 or button >= len(MOUSE_BUTTONS):
         print("Unknown mouse button: %d" % button)
+        return
+    mouse_buttons[0] &= ~MOUSE_BUTTONS[button] & 0xFF
+    scheduler.mouse_press(mouse_buttons[0])
 
-key_report = bytearray(6)
+def _notches(value):
+    # Round towards zero, the remainder is kept for the next event
+    if value >= 0:
+        return value // WHEEL_DELTA
+    return -(-value // WHEEL_DELTA)
 
-def key_down(id, modifier, button):
-    key = synergy_to_hid(id)
-    print("Key %d->%d down" % (id, key))
-    if key == 0:
-        return
-    server_button_state[button] = key
-    for n in range(6):
+def mouse_wheel(x, y):
+    """
+    Scroll by Barrier wheel deltas, 120 per notch, positive is up and right.
+    """
+    wheel_remainder[0] += y
+    wheel_remainder[1] += x
+    wheel = _notches(wheel_remainder[0])
+    pan = _notches(wheel_remainder[1])
+    wheel_remainder[0] -= wheel * WHEEL_DELTA
+    wheel_remainder[1] -= pan * WHEEL_DELTA
+    if wheel or pan:
+        scheduler.mouse_move(0, 0, wheel, pan)
+
+# Keyboard report, modifiers, reserved, then 6 keys
+key_report = bytearray(8)
+
+# Report modifier bits
+MOD_SHIFT = 0x22        # Left and right shift
+MOD_LEFT_SHIFT = 0x02
+MOD_ALTGR = 0x40        # Right alt
+MOD_SHORTCUT = 0x9D     # Control, left alt and GUI, the held modifiers are kept for shortcuts
+
+# Barrier modifier mask, the Caps Lock state of the server is passed through to the host
+KEY_MODIFIER_CAPS_LOCK = 0x1000
+
+# Modifiers held by the server
+modifier_state = bytearray(1)
+# The layout character currently pressed, the shift/AltGr state it needs and the modifier bits
+# that state overrides, the held modifiers are kept for the rest
+override = bytearray(3)
+
+def lookup_key(id):
+    """
+    Translate a KeyID to `flags << 8 | keycode`, control keys don't depend on the layout.
+    """
+    if id >= 0xE000 and id <= 0xF0FF:
+        return synergy_to_hid(id)
+    return unicode_to_hid(id)
+
+def layout_modifiers(flags):
+    mods = 0
+    if flags & LAYOUT_SHIFT:
+        mods |= MOD_LEFT_SHIFT
+    if flags & LAYOUT_ALTGR:
+        mods |= MOD_ALTGR
+    return mods
+
+def set_override(key, flags):
+    override[0] = key
+    override[1] = layout_modifiers(flags)
+    override[2] = MOD_ALTGR if flags & LAYOUT_ANY_SHIFT else MOD_SHIFT | MOD_ALTGR
+
+def _other_case(id):
+    """
+    The KeyID of the same letter in the other case, 0 if it's not a Latin-1 letter.
+    """
+    if (id >= 0x41 and id <= 0x5A) or (id >= 0x61 and id <= 0x7A):
+        return id ^ 0x20
+    if id >= 0xC0 and id <= 0xFE and id != 0xD7 and id != 0xF7 and id != 0xDF:
+        return id ^ 0x20
+    return 0
+
+def _base_key(entry):
+    # Dead key sequences end with the base character
+    if entry >> 8 & LAYOUT_DEAD:
+        d = (entry & 0xFF) * 4
+        return (layout_dead[d+3] << 8) | layout_dead[d+2]
+    return entry
+
+def caps_lock_inverts(id, key, flags):
+    """
+    Whether Caps Lock on the host turns the character into the other case,
+    i.e. the other case is the same key with shift flipped.
+    """
+    other = _other_case(id)
+    if other == 0:
+        return False
+    other = _base_key(lookup_key(other))
+    return (other & 0xFF) == key and (other >> 8) == flags ^ LAYOUT_SHIFT
+
+def send_key_report():
+    mods = modifier_state[0]
+    if override[0] != 0 and not (mods & MOD_SHORTCUT):
+        mods = (mods & ~override[2]) | override[1]
+    key_report[0] = mods & 0xFF
+    scheduler.keyboard(key_report)
+
+def press_key(key):
+    for n in range(2, 8):
+        if key_report[n] == key:
+            # Key already pressed
+            return
+    for n in range(2, 8):
         if key_report[n] == 0:
             key_report[n] = key
             break
-    # if server_button_state[button] == key:
-    #     # Key already pressed
-    #     return
-    keyboard.press(*[c for c in key_report if c!=0])
 
-def key_up(id, modifier, button):
-    server_button_state[button] = 0
-    key = synergy_to_hid(id)
-    print("Key %d->%d up" % (id, key))
-    if key == 0:
-        return
-    for n in range(6):
+def release_key(key):
+    for n in range(2, 8):
         if key_report[n] == key:
             key_report[n] = 0
             break
-    keyboard.release(key)
 
+def key_down(id, modifier, button):
+    usage = media_to_consumer(id)
+    if usage != 0:
+        scheduler.consumer(usage)
+        return
+    entry = lookup_key(id)
+    key = entry & 0xFF
+    flags = entry >> 8
+    if DEBUG:
+        print("Key %d->%d down" % (id, key))
+    if entry == 0:
+        return
+    if flags & LAYOUT_DEAD:
+        # Tap the dead key, then press the base character
+        d = key * 4
+        set_override(layout_dead[d], layout_dead[d+1])
+        press_key(layout_dead[d])
+        send_key_report()
+        release_key(layout_dead[d])
+        send_key_report()
+        key = layout_dead[d+2]
+        flags = layout_dead[d+3]
+    if modifier & KEY_MODIFIER_CAPS_LOCK and id < 0xE000 and caps_lock_inverts(id, key, flags):
+        # The host has Caps Lock on too and would invert the case once more
+        flags ^= LAYOUT_SHIFT
+    if button < len(server_button_state):
+        server_button_state[button] = key
+    if key >= 0xE0 and key <= 0xE7:
+        modifier_state[0] |= 1 << (key - 0xE0)
+    else:
+        if id < 0xE000:
+            set_override(key, flags)
+        press_key(key)
+    send_key_report()
+
+def key_up(id, modifier, button):
+    if media_to_consumer(id) != 0:
+        scheduler.consumer(0)
+        return
+    key = 0
+    if button < len(server_button_state):
+        # Release what was pressed, the key id may have changed with the modifiers
+        key = server_button_state[button]
+        server_button_state[button] = 0
+    if key == 0:
+        entry = lookup_key(id)
+        # Dead key sequences only leave the base character pressed
+        key = 0 if entry >> 8 & LAYOUT_DEAD else entry & 0xFF
+    if DEBUG:
+        print("Key %d->%d up" % (id, key))
+    if key == 0:
+        return
+    if key >= 0xE0 and key <= 0xE7:
+        modifier_state[0] &= ~(1 << (key - 0xE0)) & 0xFF
+    else:
+        if override[0] == key:
+            override[0] = 0
+        release_key(key)
+    send_key_report()
@@ -0,0 +1,157 @@
+"""
+Steady-state message handling must not allocate, the collector only runs in idle gaps on the device.
+
+The hardware modules are stubbed so the client can run on the host, and framed messages are fed
+through `BarrierClient.read_message` from a fake socket. CPython allocates every int above 256 and
+every `range`, which the device doesn't, so heap usage isn't measured directly. Instead the device
+code is traced opcode by opcode for what allocates on the device as well: building lists, tuples,
+dicts, strings, slices and functions, creating instances, raising exceptions, and calls to
+`bytearray`, `bytes` and `memoryview`.
+
+Usage:
+    python -m pytest -q
+"""
+
+import builtins
+import dis
+import os
+import sys
+import types
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+ALLOCATING_OPS = set(dis.opmap[name] for name in (
+    "BUILD_LIST", "BUILD_TUPLE", "BUILD_MAP", "BUILD_CONST_KEY_MAP", "BUILD_SET", "BUILD_STRING",
+    "BUILD_SLICE", "BINARY_SLICE", "STORE_SLICE", "MAKE_FUNCTION", "FORMAT_VALUE",
+) if name in dis.opmap)
+
+ALLOCATING_CALLS = ("bytearray", "bytes", "memoryview")
+
+class Device:
+    def send_report(self, report):
+        pass
+
+class Socket:
+    """
+    Returns every fed frame in one piece, like most messages arrive on the device.
+    """
+    def __init__(self):
+        self.data = b""
+
+    def feed(self, frame):
+        self.data = frame
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buffer, nbytes):
+        n = min(nbytes, len(self.data))
+        buffer[0:n] = self.data[0:n]
+        self.data = self.data[n:]
+        return n
+
+    def send(self, buffer):
+        return len(buffer)
+
+def _stub(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def _load():
+    ticks = [0]
+    def ticks_ms():
+        ticks[0] += 1
+        return ticks[0]
+    for name in ("board", "neopixel_write", "digitalio", "wifi", "socketpool", "microcontroller"):
+        _stub(name)
+    _stub("supervisor", ticks_ms=ticks_ms)
+    _stub("usb_hid", devices=[])
+    _stub("adafruit_hid", find_device=lambda devices, usage_page, usage: Device())
+    # Not the secrets module of the standard library
+    _stub("secrets", secrets={"LAYOUT": "us", "IDLE_GC": False})
+    sys.path.insert(0, SRC)
+    import barrier
+    import utils
+    utils.connect_any = lambda hosts, port: (Socket(), bytearray(b"CNOP"))
+    return barrier, utils
+
+barrier, utils = _load()
+DEVICE_MODULES = [m for m in sys.modules.values() if getattr(m, "__file__", None) and m.__file__.startswith(SRC)]
+
+def _frame(cmd, *fields):
+    body = cmd + b"".join(value.to_bytes(2, "big") for value in fields)
+    return len(body).to_bytes(4, "big") + body
+
+class AllocationTracer:
+    """
+    Collects the places in the device code that would allocate on the device.
+    """
+    def __init__(self):
+        self.found = []
+
+    def trace(self, frame, event, arg):
+        code = frame.f_code
+        if not code.co_filename.startswith(SRC):
+            return None
+        if event == "call":
+            frame.f_trace_opcodes = True
+            if code.co_name == "__init__":
+                self.found.append(self._where(frame, "new instance"))
+        elif event == "opcode":
+            op = code.co_code[frame.f_lasti]
+            if op in ALLOCATING_OPS:
+                self.found.append(self._where(frame, dis.opname[op]))
+        elif event == "exception":
+            self.found.append(self._where(frame, arg[0].__name__))
+        return self.trace
+
+    def counting(self, name):
+        constructor = getattr(builtins, name)
+        def construct(*args):
+            self.found.append(self._where(sys._getframe(1), name))
+            return constructor(*args)
+        return construct
+
+    def _where(self, frame, what):
+        return "%s:%d %s" % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, what)
+
+    def __enter__(self):
+        for module in DEVICE_MODULES:
+            for name in ALLOCATING_CALLS:
+                setattr(module, name, self.counting(name))
+        sys.settrace(self.trace)
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(None)
+        for module in DEVICE_MODULES:
+            for name in ALLOCATING_CALLS:
+                delattr(module, name)
+
+def _allocations(frames, rounds=20):
+    """
+    Where handling the framed messages `rounds` times allocates, after a warm up round.
+    """
+    client = barrier.BarrierClient("localhost", 24800, 2560, 1440, "test")
+    pooled = [barrier.MESSAGE_POOL[barrier.command_key(frame[4:8])] for frame in frames]
+    def handle():
+        for (frame, expected) in zip(frames, pooled):
+            client.socket.feed(frame)
+            message = client.read_message()
+            assert message is expected
+            client.on_message(message)
+            utils.scheduler.poll()
+    # First use may still set up state
+    handle()
+    with AllocationTracer() as tracer:
+        for n in range(rounds):
+            handle()
+    return sorted(set(tracer.found))
+
+def test_mouse_move_does_not_allocate():
+    assert _allocations([_frame(b"DMMV", 1000, 500), _frame(b"DMMV", 1300, 700)]) == []
+
+def test_key_down_does_not_allocate():
+    assert _allocations([_frame(b"DKDN", ord("a"), 0, 38), _frame(b"DKUP", ord("a"), 0, 38)]) == []
@@ -0,0 +1,191 @@
+"""
+Decode and analyze an event trace dumped by the device, see `src/event_trace.py`.
+
+Usage:
+    python trace_analyze.py trace.bin
+    python trace_analyze.py serial.log --records --gap-ms 50
+
+The input is either the binary file written by `TraceRecorder.dump_to_file`,
+or a captured serial log containing the base64 block printed by `TraceRecorder.dump_to_serial`.
+"""
+
+import argparse
+import binascii
+import os
+import sys
+import types
+
+# Reuse the message definitions of the device, `barrier` only needs `utils` for the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+sys.modules.setdefault("utils", types.ModuleType("utils"))
+sys.modules.setdefault("event_trace", types.ModuleType("event_trace"))
+import barrier
+
+# Must match `src/event_trace.py`
+MAGIC = b"BTRC"
+HEADER_SIZE = 12
+RECORD_SIZE = 16
+PAYLOAD_SIZE = 6
+TICKS_PERIOD = 1 << 29      # supervisor.ticks_ms wraps around
+STAGES = ["read", "decode", "dispatch", "emit", "send"]
+STAGE_SEND = 4              # Payload is the HID report, the sequence number is that of the last message read
+
+def load(path):
+    """
+    Load the raw dump, either binary or base64 from a serial log.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(MAGIC):
+        return data
+    # Take the last trace block in the log
+    lines = data.decode("utf-8", "replace").splitlines()
+    try:
+        begin = len(lines) - 1 - lines[::-1].index("-----BEGIN TRACE-----")
+        end = lines.index("-----END TRACE-----", begin)
+    except ValueError:
+        raise ValueError("No trace found in %s" % path)
+    return b"".join(binascii.a2b_base64(line) for line in lines[begin+1:end])
+
+def parse(data):
+    """
+    Parse the dump into a list of records, timestamps are unwrapped and relative to the dump time.
+    """
+    if data[0:4] != MAGIC:
+        raise ValueError("Bad trace magic")
+    if data[5] != RECORD_SIZE:
+        raise ValueError("Unsupported record size %d" % data[5])
+    count = int.from_bytes(data[6:8], "little")
+    dumped = int.from_bytes(data[8:12], "little")
+    records = []
+    last = None
+    offset = 0
+    for n in range(count):
+        r = data[HEADER_SIZE + n * RECORD_SIZE:HEADER_SIZE + (n + 1) * RECORD_SIZE]
+        if len(r) < RECORD_SIZE:
+            break
+        ticks = int.from_bytes(r[0:4], "little")
+        if last is not None and ticks < last and last - ticks > TICKS_PERIOD // 2:
+            offset += TICKS_PERIOD
+        last = ticks
+        records.append({
+            "ms": ticks + offset,
+            "cmd": r[4:8],
+            "stage": r[8],
+            "seq": r[9],
+            "payload": r[10:16],
+        })
+    # Make timestamps relative to the dump, so "10:42" can be matched against the dump time
+    end = dumped + offset
+    if end < (records[-1]["ms"] if records else 0):
+        end += TICKS_PERIOD
+    for r in records:
+        r["ms"] -= end
+    return records
+
+def describe(record):
+    """
+    Decode the recorded payload with the message definitions from `barrier.py`.
+    """
+    cmd = record["cmd"].decode("utf-8", "replace")
+    if record["stage"] == STAGE_SEND:
+        return "%s(%s)" % (cmd, record["payload"].hex(" "))
+    key = barrier.command_key(record["cmd"])
+    if key not in barrier.MESSAGE_POOL:
+        return cmd
+    message = barrier.MESSAGE_POOL[key]
+    message.buffer = bytearray(record["cmd"]) + record["payload"]
+    fields = []
+    for (name, type, offset) in message.FIELD_DEF:
+        if name.startswith("__") or type in (barrier.STRING, barrier.BYTES):
+            continue
+        size = 1 if type == barrier.INT8 else 4 if type in (barrier.INT32, barrier.SINT32) else 2
+        if offset + size > PAYLOAD_SIZE:
+            continue
+        fields.append("%s=%d" % (name, message.__getattr__(name)))
+    return "%s(%s)" % (message.__class__.__name__, ", ".join(fields))
+
+def group_messages(records):
+    """
+    Group records by message, sequence numbers wrap at 256 so a new group starts at every read.
+    """
+    messages = []
+    current = {}
+    for r in records:
+        if r["stage"] == 0 or r["seq"] != current.get("seq"):
+            current = {"seq": r["seq"], "cmd": r["cmd"], "stages": {}}
+            messages.append(current)
+        current["stages"].setdefault(r["stage"], r["ms"])
+    return messages
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report_latency(messages):
+    print("Per-stage latency (ms):")
+    print("  %-20s %6s %6s %6s %6s %6s %6s" % ("stage", "count", "min", "p50", "p90", "p99", "max"))
+    # emit -> send is the time the first report after the message waited in the scheduler
+    pairs = [(0, 1), (1, 2), (2, 3), (3, 4), (0, 3), (0, 4)]
+    for (a, b) in pairs:
+        values = [m["stages"][b] - m["stages"][a] for m in messages if a in m["stages"] and b in m["stages"]]
+        if not values:
+            continue
+        print("  %-20s %6d %6d %6d %6d %6d %6d" % (
+            "%s -> %s" % (STAGES[a], STAGES[b]), len(values),
+            min(values), percentile(values, 50), percentile(values, 90), percentile(values, 99), max(values)))
+
+def report_gaps(messages, gap_ms):
+    print("Gaps between reads longer than %d ms:" % gap_ms)
+    reads = [m for m in messages if 0 in m["stages"]]
+    found = 0
+    for (prev, m) in zip(reads, reads[1:]):
+        gap = m["stages"][0] - prev["stages"][0]
+        if gap > gap_ms:
+            found += 1
+            print("  at %9d ms: %6d ms after %s" % (m["stages"][0], gap, prev["cmd"].decode("utf-8", "replace")))
+    lost = 0
+    for (prev, m) in zip(messages, messages[1:]):
+        lost += (m["seq"] - prev["seq"] - 1) & 0xFF
+    if not found:
+        print("  none")
+    print("Missing sequence numbers: %d" % lost)
+
+def report_reorders(records):
+    print("Reorderings:")
+    found = 0
+    last = {}
+    for r in records:
+        stage = r["stage"]
+        if stage in last:
+            prev = last[stage]
+            if r["ms"] < prev["ms"] or ((r["seq"] - prev["seq"]) & 0xFF) > 0x80:
+                found += 1
+                print("  %s seq %d at %d ms after seq %d at %d ms" % (
+                    STAGES[stage], r["seq"], r["ms"], prev["seq"], prev["ms"]))
+        last[stage] = r
+    if not found:
+        print("  none")
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze an esparrier event trace")
+    parser.add_argument("path", help="binary trace or captured serial log")
+    parser.add_argument("--records", action="store_true", help="list every decoded record")
+    parser.add_argument("--gap-ms", type=int, default=100, help="report gaps between reads longer than this")
+    args = parser.parse_args()
+
+    records = parse(load(args.path))
+    if not records:
+        print("Empty trace")
+        return
+    if args.records:
+        for r in records:
+            print("%9d ms  seq %3d  %-8s  %s" % (r["ms"], r["seq"], STAGES[r["stage"]], describe(r)))
+    messages = group_messages(records)
+    print("%d records, %d messages, %d ms before the dump" % (len(records), len(messages), -records[0]["ms"]))
+    report_latency(messages)
+    report_gaps(messages, args.gap_ms)
+    report_reorders(records)
+
+if __name__ == "__main__":
+    main()